@@ -46,9 +46,15 @@
 # other computer software, distribute, and sublicense such enhancements or
 # derivative works thereof, in binary and source code form.
 
+import collections
 import contextlib
+import functools
+import hashlib
 import os
+import platform
 import re
+import shutil
+import subprocess
 import sys
 
 # Import this before distutils so that setuptools can intercept the distuils
@@ -56,6 +62,7 @@ import sys
 import setuptools  # noqa: F401 # usort: skip
 
 from distutils import log
+from distutils.errors import DistutilsExecError
 from distutils.sysconfig import get_python_lib
 from pathlib import Path
 from typing import Optional
@@ -68,12 +75,125 @@ from setuptools.command.build_py import build_py
 # For information on setuptools Command subclassing see
 # https://setuptools.pypa.io/en/latest/userguide/extension.html
 
+# The path to the root of the git repo. This setup.py file lives in the root of
+# the repo.
+_REPO_ROOT: str = str(Path(__file__).resolve().parent)
+
+_IS_DARWIN: bool = platform.system() == "Darwin"
+_IS_WINDOWS: bool = platform.system() == "Windows"
+
+
+def _is_cross_compiling() -> bool:
+    """Returns True if cmake will build for a different machine than this one.
+
+    In that case the toolchain decides which CPU features to target, and flags
+    based on the host CPU could break the build.
+    """
+    if any(
+        var in os.environ
+        for var in ("CMAKE_TOOLCHAIN_FILE", "ANDROID_NDK", "IOS_PLATFORM")
+    ):
+        return True
+    # Look for cross-compiling variables passed through CMAKE_ARGS, like
+    # -DCMAKE_TOOLCHAIN_FILE=... or -DCMAKE_SYSTEM_NAME=Android.
+    return bool(
+        re.search(
+            r"-DCMAKE_(TOOLCHAIN_FILE|SYSTEM_NAME|SYSTEM_PROCESSOR)\b",
+            os.environ.get("CMAKE_ARGS", ""),
+        )
+    )
+
+
+def _detect_simd_flags() -> str:
+    """Returns compiler flags that enable the SIMD extensions supported by the
+    host CPU, or an empty string if there are none to add.
+
+    Only x86-64 needs flags: compilers already use NEON by default on aarch64,
+    where it is always available.
+    """
+    if platform.machine().lower() not in ("x86_64", "amd64"):
+        return ""
+    cpu_flags = set()
+    try:
+        with open("/proc/cpuinfo") as fp:
+            for line in fp:
+                if line.startswith("flags"):
+                    cpu_flags = set(line.split(":", 1)[1].split())
+                    break
+    except OSError:
+        # Not Linux, or /proc is unavailable.
+        return ""
+    if {"avx2", "fma", "bmi2"} <= cpu_flags:
+        flags = ["-mavx2", "-mfma", "-mbmi2"]
+        if {"avx512f", "avx512bw", "avx512vl"} <= cpu_flags:
+            flags += ["-mavx512f", "-mavx512bw", "-mavx512vl"]
+        return " ".join(flags)
+    return ""
+
+
+def _buck_inputs_digest(repo_root: str) -> str:
+    """Returns a digest of the files that the buck2 source lists are generated
+    from: the build/cmake_deps.toml config and the TARGETS, BUCK, and .bzl files
+    around the tree.
+
+    Uses the paths, sizes, and mtimes of the files instead of their contents,
+    which is enough to notice edits and is much cheaper.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(repo_root):
+        # Skip cmake build trees, wherever they live and whatever they're
+        # called.
+        if "CMakeCache.txt" in files:
+            dirs.clear()
+            continue
+        # Targets for third-party code are declared next to the third-party
+        # directory, so skip the submodules themselves. Also skip other build
+        # outputs, virtual environments, and hidden directories like .git.
+        if os.path.basename(root) == "third-party":
+            dirs.clear()
+        dirs[:] = sorted(
+            d
+            for d in dirs
+            if not d.startswith(".")
+            and d not in ("buck-out", "pip-out", "venv")
+            and not d.startswith("cmake-out")
+        )
+        for name in sorted(files):
+            if not (
+                name in ("TARGETS", "BUCK", "cmake_deps.toml") or name.endswith(".bzl")
+            ):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # E.g., a dangling symlink, which buck2 couldn't read either.
+                continue
+            digest.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_build_type(is_debug: Optional[bool] = None) -> str:
+    """Returns the cmake build type: "Debug" or "Release".
+
+    Args:
+        is_debug: Whether to build in debug mode. If None, use the DEBUG
+            environment variable.
+    """
+    if is_debug is None:
+        is_debug = bool(int(os.environ.get("DEBUG", 0) or 0))
+    return "Debug" if is_debug else "Release"
+
 
 class ShouldBuild:
     """Indicates whether to build various components."""
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _is_env_enabled(env_var: str, default: bool = False) -> bool:
+        # Cached because each option is checked by several build commands, and
+        # the answer must not change partway through the build.
         val = os.environ.get(env_var, None)
         if val is None:
             return default
@@ -101,7 +221,6 @@ class Version:
     """Static properties that describe the version of the pip package."""
 
     # Cached values returned by the properties.
-    __root_dir_attr: Optional[str] = None
     __string_attr: Optional[str] = None
     __git_hash_attr: Optional[str] = None
 
@@ -109,28 +228,61 @@ class Version:
     @property
     def _root_dir(cls) -> str:
         """The path to the root of the git repo."""
-        if cls.__root_dir_attr is None:
-            # This setup.py file lives in the root of the repo.
-            cls.__root_dir_attr = str(Path(__file__).parent.resolve())
-        return str(cls.__root_dir_attr)
+        return _REPO_ROOT
+
+    @classmethod
+    def _read_git_hash(cls) -> Optional[str]:
+        """Reads the current git hash from the .git directory without running
+        git, or returns None if that isn't possible.
+
+        Only handles a plain .git directory whose HEAD is either detached or
+        points at a loose or packed ref. Worktrees and submodules, where .git
+        is a file, return None so that the caller can fall back to git.
+        """
+        git_dir = os.path.join(cls._root_dir, ".git")
+        try:
+            with open(os.path.join(git_dir, "HEAD")) as fp:
+                head = fp.read().strip()
+            if not head.startswith("ref: "):
+                # Detached HEAD: the file contains the hash itself.
+                sha = head
+            else:
+                ref = head[len("ref: ") :]
+                try:
+                    with open(os.path.join(git_dir, ref)) as fp:
+                        sha = fp.read().strip()
+                except FileNotFoundError:
+                    # The ref may have been packed by `git gc`.
+                    sha = ""
+                    with open(os.path.join(git_dir, "packed-refs")) as fp:
+                        for line in fp:
+                            if line.rstrip("\n").endswith(" " + ref):
+                                sha = line.split(" ", 1)[0]
+                                break
+        except OSError:
+            return None
+        if re.fullmatch(r"[0-9a-f]{40}", sha):
+            return sha
+        return None
 
     @classmethod
     @property
     def git_hash(cls) -> Optional[str]:
         """The current git hash, if known."""
         if cls.__git_hash_attr is None:
-            import subprocess
-
-            try:
-                cls.__git_hash_attr = (
-                    subprocess.check_output(
-                        ["git", "rev-parse", "HEAD"], cwd=cls._root_dir
+            # Avoid spawning a git process when the hash can be read directly.
+            cls.__git_hash_attr = cls._read_git_hash()
+            if cls.__git_hash_attr is None:
+                try:
+                    cls.__git_hash_attr = (
+                        subprocess.check_output(
+                            ["git", "rev-parse", "HEAD"], cwd=cls._root_dir
+                        )
+                        .decode("ascii")
+                        .strip()
                     )
-                    .decode("ascii")
-                    .strip()
-                )
-            except subprocess.CalledProcessError:
-                cls.__git_hash_attr = ""  # Non-None but empty.
+                except subprocess.CalledProcessError:
+                    cls.__git_hash_attr = ""  # Non-None but empty.
         # A non-None but empty value indicates that we don't know it.
         return cls.__git_hash_attr if cls.__git_hash_attr else None
 
@@ -146,9 +298,8 @@ class Version:
             if not version:
                 # Otherwise, read the version from a local file and add the git
                 # commit if available.
-                version = (
-                    open(os.path.join(cls._root_dir, "version.txt")).read().strip()
-                )
+                with open(os.path.join(cls._root_dir, "version.txt")) as fp:
+                    version = fp.read().strip()
                 if cls.git_hash:
                     version += "+" + cls.git_hash[:7]
             cls.__string_attr = version
@@ -168,13 +319,128 @@ class Version:
             fp.write("\n".join(lines) + "\n")
 
 
+def _is_up_to_date(src: str, dst: str) -> bool:
+    """Returns True if dst exists and looks like an up-to-date copy of src.
+
+    Like the update check in Command.copy_file(), but also compares the sizes.
+    Callers should still copy when the command's force option is set.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    return (
+        dst_stat.st_mtime >= src_stat.st_mtime and dst_stat.st_size == src_stat.st_size
+    )
+
+
+def _copy_file_range(src: str, dst: str) -> bool:
+    """Copies the contents of src to dst with copy_file_range(), which lets the
+    filesystem share the data blocks on copy-on-write filesystems like btrfs
+    and XFS instead of duplicating them.
+
+    Returns:
+        False if the platform or filesystem does not support it, in which case
+        the caller should fall back to another way of copying.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return remaining == 0
+    except OSError:
+        return False
+
+
+def _fast_copy(
+    command: setuptools.Command, src: str, dst: str, preserve_mode: bool = True
+) -> None:
+    """Copies src to dst like command.copy_file(), but faster.
+
+    Command.copy_file() copies the contents through a python read/write loop.
+    shutil.copyfile() uses the platform's in-kernel copy where available, like
+    sendfile() on Linux and fcopyfile() on macOS. Where available,
+    copy_file_range() is preferred since it can avoid copying the data at all.
+    Dry runs still go through command.copy_file() so that they get the usual
+    logging.
+
+    The contents are written to a temporary file next to dst, which then
+    replaces dst in one step. Processes that have the old file open or mapped,
+    like a python session that loaded a previous build of an extension, keep
+    seeing the old contents instead of a partially-written file.
+    """
+    if command.dry_run:
+        command.copy_file(src, dst, preserve_mode=preserve_mode)
+        return
+    log.info("copying %s -> %s", src, dst)
+    tmp = f"{dst}.tmp"
+    try:
+        if not _copy_file_range(src, tmp):
+            shutil.copyfile(src, tmp)
+        if preserve_mode:
+            shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+# Environment variables that cmake reads when configuring the build.
+_CONFIGURE_ENV_VARS = ("CC", "CXX", "CFLAGS", "CXXFLAGS", "LDFLAGS", "CMAKE_GENERATOR")
+
+# Known cmake configure errors, and hints about how to fix them. The earliest
+# match in the output wins. Patterns must not contain capturing groups.
+_CMAKE_ERROR_HINTS: dict[str, str] = {
+    "Cannot find source file": (
+        "Either the cmake cache is outdated or the git submodules are not "
+        "synced. Please run the following before retrying:\n"
+        "    rm -rf pip-out\n"
+        "    git submodule sync\n"
+        "    git submodule update --init"
+    ),
+    r"CMake Error at third-party/": (
+        "A third-party dependency failed to configure; its git submodule may "
+        "be missing or out of date. Please run the following before retrying:\n"
+        "    git submodule sync\n"
+        "    git submodule update --init"
+    ),
+    r"[Bb]uck2?\b.*(?:not found|No such file|failed)": (
+        "Running buck2 to generate the source lists failed. Set BUCK2 to the "
+        "path of a working buck2 binary, or delete the cached copy under "
+        "buck2-bin/ in the cmake cache directory so that it is downloaded "
+        "again."
+    ),
+}
+_CMAKE_ERROR_PATTERN = re.compile(
+    "|".join(f"({pattern})" for pattern in _CMAKE_ERROR_HINTS)
+)
+
+
+# Characters that make a path an fnmatch-style glob pattern.
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+# The extension of a shared library path on Linux.
+_SO_SUFFIX = re.compile(r"\.so$")
+
+
 class _BaseExtension(Extension):
     """A base class that maps an abstract source to an abstract destination."""
 
-    def __init__(self, src: str, dst: str, name: str):
+    def __init__(self, src: str, dst: str, name: str, target: Optional[str]):
         # Source path; semantics defined by the subclass.
         self.src: str = src
 
+        # The cmake target that produces src, if any.
+        self.target: Optional[str] = target
+
         # Destination path relative to a namespace defined elsewhere. If this ends
         # in "/", it is treated as a directory. If this is "", it is treated as the
         # root of the namespace.
@@ -186,6 +452,12 @@ class _BaseExtension(Extension):
         # that doesn't look like a module path.
         self.name: str = name
 
+        # Resolved paths returned by src_path() and dst_path(), which are
+        # called several times per extension. Keyed by the installer settings
+        # that the paths depend on.
+        self._src_path_cache: dict[Path, Path] = {}
+        self._dst_path_cache: dict[tuple, Path] = {}
+
         super().__init__(name=self.name, sources=[])
 
     def src_path(self, installer: "InstallerBuildExt") -> Path:
@@ -195,16 +467,30 @@ class _BaseExtension(Extension):
             installer: The InstallerBuildExt instance that is installing the
                 file.
         """
-        # TODO(dbort): share the cmake-out location with CustomBuild. Can get a
-        # handle with installer.get_finalized_command('build')
-        cmake_cache_dir: Path = Path().cwd() / installer.build_temp / "cmake-out"
+        cmake_cache_dir: Path = installer.cmake_cache_dir
+        if cmake_cache_dir not in self._src_path_cache:
+            self._src_path_cache[cmake_cache_dir] = self._find_src(
+                cmake_cache_dir, self.src
+            )
+        return self._src_path_cache[cmake_cache_dir]
 
-        # Construct the full source path, resolving globs. If there are no glob
-        # pattern characters, this will just ensure that the source file exists.
-        srcs = tuple(cmake_cache_dir.glob(self.src))
+    def _find_src(self, cmake_cache_dir: Path, src: str) -> Path:
+        """Returns the path to the one file under cmake_cache_dir that matches
+        src, which may be a glob. Raises ValueError if there is no such file.
+        """
+        if not _GLOB_CHARS.search(src):
+            # Not a glob, so a single stat is enough to check that the source
+            # file exists; globbing would scan every directory on the path.
+            path = cmake_cache_dir / src
+            if not path.exists():
+                raise ValueError(f"Expected to find '{src}' in {cmake_cache_dir}")
+            return path
+
+        # Construct the full source path, resolving globs.
+        srcs = tuple(cmake_cache_dir.glob(src))
         if len(srcs) != 1:
             raise ValueError(
-                f"Expected exactly one file matching '{self.src}'; found {repr(srcs)}"
+                f"Expected exactly one file matching '{src}'; found {repr(srcs)}"
             )
         return srcs[0]
 
@@ -218,7 +504,7 @@ class BuiltFile(_BaseExtension):
     `ext_modules`.
     """
 
-    def __init__(self, src: str, dst: str):
+    def __init__(self, src: str, dst: str, target: Optional[str] = None):
         """Initializes a BuiltFile.
 
         Args:
@@ -228,11 +514,18 @@ class BuiltFile(_BaseExtension):
             dst: The path to install to, relative to the root of the pip
                 package. If dst ends in "/", it is treated as a directory.
                 Otherwise it is treated as a filename.
+            target: The cmake target that builds src. If set, CustomBuild will
+                build it.
         """
         # This is not a real extension, so use a unique name that doesn't look
         # like a module path. Some of setuptools's autodiscovery will look for
         # extension names with prefixes that match certain module paths.
-        super().__init__(src=src, dst=dst, name=f"@EXECUTORCH_BuiltFile_{src}:{dst}")
+        super().__init__(
+            src=src,
+            dst=dst,
+            name=f"@EXECUTORCH_BuiltFile_{src}:{dst}",
+            target=target,
+        )
 
     def dst_path(self, installer: "InstallerBuildExt") -> Path:
         """Returns the path to the destination file.
@@ -241,21 +534,27 @@ class BuiltFile(_BaseExtension):
             installer: The InstallerBuildExt instance that is installing the
                 file.
         """
-        dst_root = Path(installer.build_lib).resolve()
+        key = (installer.build_lib,)
+        if key in self._dst_path_cache:
+            return self._dst_path_cache[key]
+
+        dst_root = installer.build_lib_root
 
         if self.dst.endswith("/"):
             # Destination looks like a directory. Use the basename of the source
             # file for its final component.
-            return dst_root / Path(self.dst) / self.src_path(installer).name
+            dst = dst_root / Path(self.dst) / self.src_path(installer).name
         else:
             # Destination looks like a file.
-            return dst_root / Path(self.dst)
+            dst = dst_root / Path(self.dst)
+        self._dst_path_cache[key] = dst
+        return dst
 
 
 class BuiltExtension(_BaseExtension):
     """An extension that installs a python extension that was built by cmake."""
 
-    def __init__(self, src: str, modpath: str):
+    def __init__(self, src: str, modpath: str, target: Optional[str] = None):
         """Initializes a BuiltExtension.
 
         Args:
@@ -265,32 +564,24 @@ class BuiltExtension(_BaseExtension):
                 this class will also look for similarly-named `.dylib` files.
             modpath: The dotted path of the python module that maps to the
                 extension.
+            target: The cmake target that builds src. If set, CustomBuild will
+                build it.
         """
         assert (
             "/" not in modpath
         ), f"modpath must be a dotted python module path: saw '{modpath}'"
         # This is a real extension, so use the modpath as the name.
-        super().__init__(src=src, dst=modpath, name=modpath)
+        super().__init__(src=src, dst=modpath, name=modpath, target=target)
 
-    def src_path(self, installer: "InstallerBuildExt") -> Path:
-        """Returns the path to the source file, resolving globs.
-
-        Args:
-            installer: The InstallerBuildExt instance that is installing the
-                file.
-        """
-        try:
-            return super().src_path(installer)
-        except ValueError:
-            # Probably couldn't find the file. If the path ends with .so, try
-            # looking for a .dylib file instead, in case we're running on macos.
-            if self.src.endswith(".so"):
-                dylib_src = re.sub(r"\.so$", ".dylib", self.src)
-                return BuiltExtension(src=dylib_src, modpath=self.dst).src_path(
-                    installer
-                )
-            else:
-                raise
+    def _find_src(self, cmake_cache_dir: Path, src: str) -> Path:
+        if _IS_DARWIN and src.endswith(".so"):
+            # Shared libraries are usually named .dylib on macos, so look for
+            # that first.
+            try:
+                return super()._find_src(cmake_cache_dir, _SO_SUFFIX.sub(".dylib", src))
+            except ValueError:
+                pass
+        return super()._find_src(cmake_cache_dir, src)
 
     def dst_path(self, installer: "InstallerBuildExt") -> Path:
         """Returns the path to the destination file.
@@ -301,8 +592,12 @@ class BuiltExtension(_BaseExtension):
         """
         # Our destination is a dotted module path. get_ext_fullpath() returns
         # the relative path to the .so/.dylib/etc. file that maps to the module
-        # path: that's the file we're creating.
-        return Path(installer.get_ext_fullpath(self.dst))
+        # path: that's the file we're creating. The result depends on whether
+        # the extension is being built in-place.
+        key = (installer.build_lib, installer.inplace)
+        if key not in self._dst_path_cache:
+            self._dst_path_cache[key] = Path(installer.get_ext_fullpath(self.dst))
+        return self._dst_path_cache[key]
 
 
 class InstallerBuildExt(build_ext):
@@ -310,25 +605,71 @@ class InstallerBuildExt(build_ext):
 
     # TODO(dbort): Depend on the "build" command to ensure it runs first
 
+    def finalize_options(self):
+        super().finalize_options()
+
+        # Look these up once here instead of once per extension.
+
+        # The directory that CustomBuild builds into.
+        self.cmake_cache_dir = self.get_finalized_command("build").cmake_cache_path
+        # The root directory to install files under.
+        self.build_lib_root = Path(self.build_lib).resolve()
+
     def build_extension(self, ext: _BaseExtension) -> None:
-        src_file: Path = ext.src_path(self)
+        try:
+            src_file: Path = ext.src_path(self)
+        except ValueError:
+            if not self.dry_run:
+                raise
+            # A dry run doesn't build anything, so there may be nothing to
+            # install yet.
+            log.info(f"skipping {ext.name}: {ext.src} has not been built")
+            return
         dst_file: Path = ext.dst_path(self)
 
+        # Like copy_file, copy into the destination if it is an existing
+        # directory, e.g., a python package directory created by build_py.
+        if dst_file.is_dir():
+            dst_file = dst_file / src_file.name
+
         # Ensure that the destination directory exists.
         self.mkpath(os.fspath(dst_file.parent))
 
-        # Copy the file.
-        self.copy_file(os.fspath(src_file), os.fspath(dst_file))
+        # Copy the file, unless a previous build already installed it and
+        # --force wasn't passed.
+        if self.force or not _is_up_to_date(os.fspath(src_file), os.fspath(dst_file)):
+            _fast_copy(self, os.fspath(src_file), os.fspath(dst_file))
 
         # Ensure that the destination file is writable, even if the source was
         # not. build_py does this by passing preserve_mode=False to copy_file,
         # but that would clobber the X bit on any executables. TODO(dbort): This
         # probably won't work on Windows.
-        if not os.access(src_file, os.W_OK):
+        if not self.dry_run and not os.access(src_file, os.W_OK):
             # Make the file writable. This should respect the umask.
             os.chmod(src_file, os.stat(src_file).st_mode | 0o222)
 
 
+# Resource files that CustomBuildPy copies into the output package directory,
+# as (source path relative to the repo root, destination path relative to the
+# `executorch` package) pairs.
+#
+# TODO(dbort): See if we can add a custom pyproject.toml section for these,
+# instead of hard-coding them here. See
+# https://setuptools.pypa.io/en/latest/userguide/extension.html
+_RESOURCE_FILES: tuple[tuple[str, str], ...] = (
+    ("schema/scalar_type.fbs", "exir/_serialize/scalar_type.fbs"),
+    ("schema/program.fbs", "exir/_serialize/program.fbs"),
+    (
+        "sdk/bundled_program/schema/bundled_program_schema.fbs",
+        "sdk/bundled_program/serialize/bundled_program_schema.fbs",
+    ),
+    (
+        "sdk/bundled_program/schema/scalar_type.fbs",
+        "sdk/bundled_program/serialize/scalar_type.fbs",
+    ),
+)
+
+
 class CustomBuildPy(build_py):
     """Copies platform-independent files from the source tree into the output
     package directory.
@@ -359,34 +700,24 @@ class CustomBuildPy(build_py):
         # Manually copy files into the output package directory. These are
         # typically python "resource" files that will live alongside the python
         # code that uses them.
-        src_to_dst = [
-            # TODO(dbort): See if we can add a custom pyproject.toml section for
-            # these, instead of hard-coding them here. See
-            # https://setuptools.pypa.io/en/latest/userguide/extension.html
-            ("schema/scalar_type.fbs", "exir/_serialize/scalar_type.fbs"),
-            ("schema/program.fbs", "exir/_serialize/program.fbs"),
-            (
-                "sdk/bundled_program/schema/bundled_program_schema.fbs",
-                "sdk/bundled_program/serialize/bundled_program_schema.fbs",
-            ),
-            (
-                "sdk/bundled_program/schema/scalar_type.fbs",
-                "sdk/bundled_program/serialize/scalar_type.fbs",
-            ),
-        ]
-        for src, dst in src_to_dst:
+        for src, dst in _RESOURCE_FILES:
             dst = os.path.join(dst_root, dst)
 
             # When modifying the filesystem, use the self.* methods defined by
             # Command to benefit from the same logging and dry_run logic as
             # setuptools.
 
+            # Skip files that a previous build already copied, unless --force
+            # was passed.
+            if not self.force and _is_up_to_date(src, dst):
+                continue
+
             # Ensure that the destination directory exists.
             self.mkpath(os.path.dirname(dst))
             # Follow the example of the base build_py class by not preserving
             # the mode. This ensures that the output file is read/write even if
             # the input file is read-only.
-            self.copy_file(src, dst, preserve_mode=False)
+            _fast_copy(self, src, dst, preserve_mode=False)
 
 
 class Buck2EnvironmentFixer(contextlib.AbstractContextManager):
@@ -420,6 +751,11 @@ class Buck2EnvironmentFixer(contextlib.AbstractContextManager):
 
 
 class CustomBuild(build):
+    user_options = build.user_options + [
+        ("clean", None, "regenerate the cmake cache and source lists from scratch"),
+    ]
+    boolean_options = build.boolean_options + ["clean"]
+
     def initialize_options(self):
         super().initialize_options()
         # The default build_base directory is called "build", but we have a
@@ -430,20 +766,363 @@ class CustomBuild(build):
         # setuptools/_distutils/command/build.py for the default.
         self.build_base = "pip-out"
 
-        # Default build parallelism based on number of cores, but allow
-        # overriding through the environment.
-        default_parallel = str(os.cpu_count() - 1)
-        self.parallel = os.environ.get("CMAKE_BUILD_PARALLEL_LEVEL", default_parallel)
+        # Default build parallelism based on number of cores, leaving one core
+        # free but always using at least one, and allow overriding through the
+        # environment. Prefer the set of cores this process may run on, which
+        # respects CPU limits like taskset and container cpusets, but that
+        # isn't available on all platforms; os.cpu_count() may return None.
+        if hasattr(os, "sched_getaffinity"):
+            num_cpus = len(os.sched_getaffinity(0))
+        else:
+            num_cpus = os.cpu_count() or 1
+        default_parallel = str(max(1, num_cpus - 1))
+        self.parallel = os.environ.get("CMAKE_BUILD_PARALLEL_LEVEL") or default_parallel
+
+        # By default, reuse the cmake cache from earlier builds so that only
+        # the changed parts of the project need to be reconfigured and rebuilt.
+        self.clean = False
+
+    def finalize_options(self):
+        super().finalize_options()
+
+        # Put the cmake cache under the temp directory, like
+        # "pip-out/temp.<plat>/cmake-out", which persists across builds.
+        # Resolve the path once; the build commands and every installed
+        # extension refer to it.
+        self.cmake_cache_path = Path(self.build_temp, "cmake-out").resolve()
+        self.cmake_cache_dir = str(self.cmake_cache_path)
+
+    def _purge_stale_cmake_cache(
+        self, cmake_cache_dir: str, repo_root: str, generator: Optional[str]
+    ) -> None:
+        """Deletes the cmake cache directory if it was configured for a
+        different source directory or with a different generator.
+
+        This happens when the repo is moved, when the same checkout is mounted
+        at different paths, e.g., on the host and in a docker container, or
+        when ninja is installed or removed. cmake refuses to reuse such a cache.
+
+        Args:
+            cmake_cache_dir: The cmake build directory.
+            repo_root: The source directory that cmake will configure.
+            generator: The cmake generator that will be used, or None if it
+                isn't known.
+        """
+        cached = {}
+        try:
+            with open(os.path.join(cmake_cache_dir, "CMakeCache.txt")) as fp:
+                for line in fp:
+                    for key in ("CMAKE_HOME_DIRECTORY", "CMAKE_GENERATOR"):
+                        if line.startswith(f"{key}:INTERNAL="):
+                            cached[key] = line.split("=", 1)[1].strip()
+        except FileNotFoundError:
+            return
+        reason = None
+        home_dir = cached.get("CMAKE_HOME_DIRECTORY")
+        if home_dir and os.path.realpath(home_dir) != os.path.realpath(repo_root):
+            reason = f"configured for {home_dir}"
+        cached_generator = cached.get("CMAKE_GENERATOR")
+        if generator and cached_generator and cached_generator != generator:
+            reason = f"generated for {cached_generator}"
+        if reason is None:
+            return
+        log.info(f"deleting {cmake_cache_dir} {reason}")
+        if not self.dry_run:
+            shutil.rmtree(cmake_cache_dir)
+
+    @staticmethod
+    def _configure_stamp(
+        repo_root: str, cmake_args: list[str], buck_inputs_digest: str
+    ) -> str:
+        """Returns a digest of the inputs to the cmake configure step.
+
+        The generated build system already re-runs cmake when any CMakeLists.txt
+        changes, so configuring again is only needed when the args change, when
+        the top-level CMakeLists.txt changes in a way that the previous
+        configure step may not have seen, or when the buck2 targets that the
+        source lists are generated from change.
+
+        The build tree also refers to cmake, the build tool, and the compilers
+        by absolute path, and cmake chooses them based on the environment, so
+        configure again when any of those change. This happens, e.g., when pip
+        builds in a new isolated environment that provides its own cmake and
+        ninja, or when the user switches compilers with CC/CXX.
+        """
+        tools = (
+            "cmake",
+            "ninja",
+            "make",
+            os.environ.get("CC") or "cc",
+            os.environ.get("CXX") or "c++",
+        )
+        digest = hashlib.sha256()
+        for value in (
+            *cmake_args,
+            *(os.environ.get(var, "") for var in _CONFIGURE_ENV_VARS),
+            *(shutil.which(tool) or "" for tool in tools),
+        ):
+            digest.update(value.encode())
+            digest.update(b"\0")
+        mtime = os.stat(os.path.join(repo_root, "CMakeLists.txt")).st_mtime_ns
+        digest.update(str(mtime).encode())
+        digest.update(buck_inputs_digest.encode())
+        return digest.hexdigest()
+
+    def _spawn_cmake(self, cmd: list[str]) -> None:
+        """Runs a cmake command like self.spawn(), but adds hints about how to
+        fix common problems to the error if the command fails.
+
+        The command's stdout goes straight to ours. Its stderr is streamed as
+        it runs, keeping only the most recent lines in memory to look for known
+        errors.
+        """
+        log.info(subprocess.list2cmdline(cmd))
+        if self.dry_run:
+            return
+
+        tail = collections.deque(maxlen=4096)
+        try:
+            with subprocess.Popen(
+                cmd,
+                stderr=subprocess.PIPE,
+                text=True,
+                errors="replace",
+                bufsize=1,
+            ) as proc:
+                for line in proc.stderr:
+                    sys.stderr.write(line)
+                    tail.append(line)
+        except OSError as e:
+            raise DistutilsExecError(f"command {cmd[0]!r} failed: {e}") from e
+        if proc.returncode == 0:
+            return
+
+        # Our educated guesses from parsing the error message.
+        message = f"command {cmd[0]!r} failed with exit code {proc.returncode}"
+        match = _CMAKE_ERROR_PATTERN.search("".join(tail))
+        if match:
+            # Each pattern is a single group, in the same order as the hints.
+            message += "\n" + tuple(_CMAKE_ERROR_HINTS.values())[match.lastindex - 1]
+        raise DistutilsExecError(message)
+
+    def _generator_args(self) -> tuple[Optional[str], list[str]]:
+        """Returns the cmake generator to use, or None to let cmake choose, and
+        the cmake args that select it.
+        """
+        # Prefer the Ninja generator when it's installed: it schedules the
+        # whole build graph at once, and its no-op rebuilds are much faster.
+        # Respect any generator chosen through the environment.
+        if (
+            not shutil.which("ninja")
+            or "CMAKE_GENERATOR" in os.environ
+            or re.search(r"(^|\s)-G", os.environ.get("CMAKE_ARGS", ""))
+        ):
+            return None, []
+        generator = "Ninja"
+        return generator, [
+            f"-G{generator}",
+            # Compile with full parallelism but link one target at a time:
+            # links are much more memory hungry, and running many at once can
+            # exhaust memory on smaller machines.
+            f"-DCMAKE_JOB_POOLS=compile={self.parallel};link=1",
+            "-DCMAKE_JOB_POOL_COMPILE=compile",
+            "-DCMAKE_JOB_POOL_LINK=link",
+        ]
+
+    @staticmethod
+    def _compiler_launcher_args() -> list[str]:
+        """Returns the cmake args that wrap the compilers in a compiler cache."""
+        # Use a compiler cache if one is installed, so that recompiling
+        # unchanged sources is nearly free. Set EXECUTORCH_DISABLE_CCACHE=1 to
+        # opt out.
+        launcher = shutil.which("sccache") or shutil.which("ccache")
+        if not launcher or ShouldBuild._is_env_enabled("EXECUTORCH_DISABLE_CCACHE"):
+            return []
+        # Unless the user has configured ccache differently, identify the
+        # compiler by its contents rather than its mtime, which changes
+        # whenever an environment is recreated, and don't let timestamps alone
+        # cause cache misses.
+        os.environ.setdefault("CCACHE_COMPILERCHECK", "content")
+        os.environ.setdefault(
+            "CCACHE_SLOPPINESS", "pch_defines,time_macros,include_file_mtime"
+        )
+        return [
+            f"-DCMAKE_C_COMPILER_LAUNCHER={launcher}",
+            f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}",
+        ]
+
+    @staticmethod
+    def _compiler_flag_args(cfg: str) -> list[str]:
+        """Returns the cmake args that add optional compiler flags.
+
+        Args:
+            cfg: The cmake build type.
+        """
+        cmake_args = []
+        # Note that the top-level CMakeLists.txt overwrites
+        # CMAKE_CXX_FLAGS_RELEASE, so flags need to be added to
+        # CMAKE_<LANG>_FLAGS.
+        c_flags: list[str] = []
+        cxx_flags: list[str] = []
+
+        # Let the compiler use the SIMD extensions of the host CPU. The
+        # resulting binaries crash on CPUs without those extensions, so this is
+        # opt-in: set EXECUTORCH_ENABLE_SIMD_AUTODETECT=1 for builds that will
+        # only run on this machine. It is still skipped when building a
+        # versioned release (BUILD_VERSION), since those wheels must run on any
+        # CPU, when cross-compiling for a different CPU, and when the user
+        # provides their own compiler flags.
+        if ShouldBuild._is_env_enabled("EXECUTORCH_ENABLE_SIMD_AUTODETECT") and not (
+            os.environ.get("BUILD_VERSION", "").strip()
+            or _is_cross_compiling()
+            or "CFLAGS" in os.environ
+            or "CXXFLAGS" in os.environ
+        ):
+            simd_flags = _detect_simd_flags()
+            if simd_flags:
+                c_flags.append(simd_flags)
+                cxx_flags.append(simd_flags)
+
+        # Hide symbols that aren't explicitly exported, which shrinks the
+        # dynamic symbol tables of the shared libraries and lets the compiler
+        # inline and drop more code. Set EXECUTORCH_STRICT_VIS=1 to opt in.
+        # Release builds also enable link-time optimization, which requires a
+        # toolchain that supports it.
+        if ShouldBuild._is_env_enabled("EXECUTORCH_STRICT_VIS") and not _IS_WINDOWS:
+            c_flags.append("-fvisibility=hidden")
+            cxx_flags.append("-fvisibility=hidden -fvisibility-inlines-hidden")
+            if not _IS_DARWIN:
+                c_flags.append("-fno-semantic-interposition")
+                cxx_flags.append("-fno-semantic-interposition")
+            if cfg == "Release":
+                cmake_args.append("-DCMAKE_INTERPROCEDURAL_OPTIMIZATION=ON")
+
+        # Setting CMAKE_<LANG>_FLAGS replaces the flags that cmake would
+        # otherwise take from the environment, so keep those too.
+        for lang, env_var, flags in (
+            ("C", "CFLAGS", c_flags),
+            ("CXX", "CXXFLAGS", cxx_flags),
+        ):
+            if flags:
+                flags = [os.environ.get(env_var, "").strip(), *flags]
+                cmake_args.append(
+                    f"-DCMAKE_{lang}_FLAGS={' '.join(filter(None, flags))}"
+                )
+        return cmake_args
+
+    def _build_targets(self) -> list[str]:
+        """Returns the cmake targets that produce the files to install."""
+        targets = ["flatc"]
+        for ext in self.distribution.ext_modules or []:
+            target = getattr(ext, "target", None)
+            if target and target not in targets:
+                targets.append(target)
+        return targets
+
+    def _delete_stale_source_lists(self, buck_inputs_digest: str) -> Path:
+        """Deletes the source lists generated by an earlier configure step if
+        the buck2 targets they came from have changed, or when asked for a
+        clean build.
+
+        cmake reuses the generated source lists if the file exists, since
+        generating them runs a buck2 query, which is slow.
+
+        Returns:
+            The path of the stamp file to record buck_inputs_digest in once the
+            source lists have been regenerated.
+        """
+        srcs_file = self.cmake_cache_path / "executorch_srcs.cmake"
+        srcs_stamp_file = self.cmake_cache_path / ".executorch_srcs_hash"
+        if srcs_file.exists() and (
+            self.clean
+            or not srcs_stamp_file.exists()
+            or srcs_stamp_file.read_text() != buck_inputs_digest
+        ):
+            log.info(f"deleting {srcs_file}")
+            if not self.dry_run:
+                srcs_file.unlink()
+        return srcs_stamp_file
+
+    def _configure(self, repo_root: str, cmake_args: list[str]) -> None:
+        """Generates the build system files, unless the existing cmake cache
+        was generated from the same inputs.
+
+        Skipping the configure step matters since it can spend a long time
+        probing the toolchain and running buck2.
+        """
+        cmake_cache_file = self.cmake_cache_path / "CMakeCache.txt"
+        stamp_file = self.cmake_cache_path / ".executorch_cmake_args_hash"
+        buck_inputs_digest = _buck_inputs_digest(repo_root)
+        stamp = self._configure_stamp(repo_root, cmake_args, buck_inputs_digest)
+        if (
+            not self.clean
+            and cmake_cache_file.exists()
+            and stamp_file.exists()
+            and stamp_file.read_text() == stamp
+        ):
+            log.info(f"skipping cmake configure; {self.cmake_cache_dir} is up to date")
+            return
+
+        # cmake keeps any -D values from earlier runs that are no longer
+        # passed, e.g., options that were turned off since. Delete the cache
+        # file to ensure that the cache state is predictable, but keep the rest
+        # of the build directory so that unchanged objects don't need to be
+        # rebuilt.
+        if cmake_cache_file.exists():
+            log.info(f"deleting {cmake_cache_file}")
+        if not self.dry_run:
+            # Dry run should log the command but not actually run it.
+            cmake_cache_file.unlink(missing_ok=True)
+            # Forget the old stamp in case this configure step fails partway
+            # through updating the cache.
+            stamp_file.unlink(missing_ok=True)
+        srcs_stamp_file = self._delete_stale_source_lists(buck_inputs_digest)
+
+        with Buck2EnvironmentFixer():
+            # The context manager may patch the environment while running this
+            # cmake command, which happens to run buck2 to get some source
+            # lists.
+            self._spawn_cmake(
+                ["cmake", "-S", repo_root, "-B", self.cmake_cache_dir, *cmake_args]
+            )
+        if not self.dry_run:
+            stamp_file.write_text(stamp)
+            srcs_stamp_file.write_text(buck_inputs_digest)
+
+    def _build_while_running_build_py(self, build_cmd: list[str]) -> None:
+        """Runs the cmake build command while running the build_py command."""
+        if self.dry_run:
+            self.spawn(build_cmd)
+            self.run_command("build_py")
+            return
+
+        log.info(subprocess.list2cmdline(build_cmd))
+        try:
+            proc = subprocess.Popen(build_cmd)
+        except OSError as e:
+            raise DistutilsExecError(f"command {build_cmd[0]!r} failed: {e}")
+        try:
+            self.run_command("build_py")
+        except BaseException:
+            proc.terminate()
+            proc.wait()
+            raise
+        if proc.wait() != 0:
+            raise DistutilsExecError(
+                f"command {build_cmd[0]!r} failed with exit code {proc.returncode}"
+            )
 
     def run(self):
         self.dump_options()
 
-        debug = int(os.environ.get("DEBUG", 0)) if self.debug is None else self.debug
-        cfg = "Debug" if debug else "Release"
+        cfg = get_build_type(self.debug)
 
         # get_python_lib() typically returns the path to site-packages, where
-        # all pip packages in the environment are installed.
-        cmake_prefix_path = os.environ.get("CMAKE_PREFIX_PATH", get_python_lib())
+        # all pip packages in the environment are installed. Only call it when
+        # needed, since it has to inspect the interpreter's install scheme.
+        cmake_prefix_path = os.environ.get("CMAKE_PREFIX_PATH")
+        if cmake_prefix_path is None:
+            cmake_prefix_path = get_python_lib()
 
         # The root of the repo should be the current working directory. Get
         # the absolute path.
@@ -474,11 +1153,23 @@ class CustomBuild(build):
             "-DEXECUTORCH_SEPARATE_FLATCC_HOST_PROJECT=OFF",
         ]
 
+        generator, generator_args = self._generator_args()
+        cmake_args += generator_args
+        cmake_args += self._compiler_launcher_args()
+        cmake_args += self._compiler_flag_args(cfg)
+
         build_args = [f"-j{self.parallel}"]
 
-        # TODO(dbort): Try to manage these targets and the cmake args from the
-        # extension entries themselves instead of hard-coding them here.
-        build_args += ["--target", "flatc"]
+        # Also let any cmake builds nested inside this one, like external
+        # projects, use the same parallelism.
+        os.environ.setdefault("CMAKE_BUILD_PARALLEL_LEVEL", str(self.parallel))
+
+        # TODO(dbort): Try to manage the cmake args from the extension entries
+        # themselves instead of hard-coding them here.
+
+        # Only build the targets that produce the files we install, plus flatc,
+        # which is always built. Pass them all to a single --target.
+        build_args += ["--target", *self._build_targets()]
 
         if ShouldBuild.pybindings:
             cmake_args += [
@@ -486,7 +1177,6 @@ class CustomBuild(build):
                 "-DEXECUTORCH_BUILD_KERNELS_QUANTIZED=ON",  # add quantized ops to pybindings.
                 "-DEXECUTORCH_BUILD_KERNELS_QUANTIZED_AOT=ON",
             ]
-            build_args += ["--target", "portable_lib"]
             # To link backends into the portable_lib target, callers should
             # add entries like `-DEXECUTORCH_BUILD_XNNPACK=ON` to the CMAKE_ARGS
             # environment variable.
@@ -496,7 +1186,6 @@ class CustomBuild(build):
                 "-DEXECUTORCH_BUILD_KERNELS_CUSTOM=ON",  # add llama sdpa ops to pybindings.
                 "-DEXECUTORCH_BUILD_KERNELS_CUSTOM_AOT=ON",
             ]
-            build_args += ["--target", "custom_ops_aot_lib"]
         # Allow adding extra cmake args through the environment. Used by some
         # tests and demos to expand the set of targets included in the pip
         # package.
@@ -511,28 +1200,18 @@ class CustomBuild(build):
                 item for item in os.environ["CMAKE_BUILD_ARGS"].split(" ") if item
             ]
 
-        # Put the cmake cache under the temp directory, like
-        # "pip-out/temp.<plat>/cmake-out".
-        cmake_cache_dir = os.path.join(repo_root, self.build_temp, "cmake-out")
+        cmake_cache_dir = self.cmake_cache_dir
+        self._purge_stale_cmake_cache(cmake_cache_dir, repo_root, generator)
         self.mkpath(cmake_cache_dir)
 
-        # Generate the cmake cache from scratch to ensure that the cache state
-        # is predictable.
-        cmake_cache_file = Path(cmake_cache_dir) / "CMakeCache.txt"
-        log.info(f"deleting {cmake_cache_file}")
-        if not self.dry_run:
-            # Dry run should log the command but not actually run it.
-            (Path(cmake_cache_dir) / "CMakeCache.txt").unlink(missing_ok=True)
-        with Buck2EnvironmentFixer():
-            # The context manager may patch the environment while running this
-            # cmake command, which happens to run buck2 to get some source
-            # lists.
-
-            # Generate the build system files.
-            self.spawn(["cmake", "-S", repo_root, "-B", cmake_cache_dir, *cmake_args])
+        self._configure(repo_root, cmake_args)
 
-        # Build the system.
-        self.spawn(["cmake", "--build", cmake_cache_dir, *build_args])
+        # Build the system. build_py only copies files from the source tree, so
+        # run it while cmake is busy compiling. build.run() below will not run
+        # it again.
+        self._build_while_running_build_py(
+            ["cmake", "--build", cmake_cache_dir, *build_args]
+        )
 
         # Non-python files should live under this data directory.
         data_root = os.path.join(self.build_lib, "executorch", "data")
@@ -544,10 +1223,9 @@ class CustomBuild(build):
         # data/bin, as long as they are listed in the [project.scripts] section
         # of pyproject.toml.
         self.mkpath(bin_dir)
-        self.copy_file(
-            "build/pip_data_bin_init.py.in",
-            os.path.join(bin_dir, "__init__.py"),
-        )
+        bin_init = os.path.join(bin_dir, "__init__.py")
+        if self.force or not _is_up_to_date("build/pip_data_bin_init.py.in", bin_init):
+            _fast_copy(self, "build/pip_data_bin_init.py.in", bin_init)
 
         # Finally, run the underlying subcommands like build_py, build_ext.
         build.run(self)
@@ -556,29 +1234,36 @@ class CustomBuild(build):
 def get_ext_modules() -> list[Extension]:
     """Returns the set of extension modules to build."""
 
-    ext_modules = []
-    if ShouldBuild.flatc:
-        ext_modules.append(
-            BuiltFile("third-party/flatbuffers/flatc", "executorch/data/bin/")
-        )
-
-    if ShouldBuild.pybindings:
-        ext_modules.append(
+    # Pairs of (whether to build, extension to install).
+    candidates = (
+        (
+            ShouldBuild.flatc,
+            BuiltFile(
+                "third-party/flatbuffers/flatc", "executorch/data/bin/", target="flatc"
+            ),
+        ),
+        (
+            ShouldBuild.pybindings,
             # Install the prebuilt pybindings extension wrapper for the runtime,
             # portable kernels, and a selection of backends. This lets users
             # load and execute .pte files from python.
             BuiltExtension(
-                "_portable_lib.*", "executorch.extension.pybindings._portable_lib"
-            )
-        )
-    if ShouldBuild.llama_custom_ops:
-        ext_modules.append(
+                "_portable_lib.*",
+                "executorch.extension.pybindings._portable_lib",
+                target="portable_lib",
+            ),
+        ),
+        (
+            ShouldBuild.llama_custom_ops,
             # Install the prebuilt library for custom ops used in llama.
             BuiltFile(
                 "examples/models/llama2/custom_ops/libcustom_ops_aot_lib.*",
                 "executorch/examples/models/llama2/custom_ops",
-            )
-        )
+                target="custom_ops_aot_lib",
+            ),
+        ),
+    )
+    ext_modules = [ext for enabled, ext in candidates if enabled]
 
     # Note that setuptools uses the presence of ext_modules as the main signal
     # that a wheel is platform-specific. If we install any platform-specific